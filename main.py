@@ -1,16 +1,28 @@
 # main.py
-import os, io, csv
-from datetime import datetime
+import os, io, csv, logging
+from contextlib import ExitStack
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+from itertools import islice
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 import psycopg
+from psycopg_pool import ConnectionPool
 import boto3
+from boto3.s3.transfer import TransferConfig
+import ciso8601
+import orjson
 from botocore.config import Config
 
-app = FastAPI(title="restaurant-ai")
+# dict の返り値は jsonable_encoder を通った後 orjson でエンコードされる
+app = FastAPI(title="restaurant-ai", default_response_class=ORJSONResponse)
 
 DB_URL = os.environ["DATABASE_URL"]
 
+logger = logging.getLogger("restaurant-ai")
+
 DDL = """
 create table if not exists raw_sales(
   id bigserial primary key,
@@ -38,25 +50,48 @@ create table if not exists ai_reports(
   created_at timestamptz default now()
 );
 """
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_chunksize=8 * 1024 * 1024, max_concurrency=4, use_threads=True
+)
+
+@lru_cache(maxsize=1)
 def s3_client():
-    s3 = boto3.client(
+    # 初回だけ Session/クライアントを作って使い回す（認証情報の読込や接続プールを毎回作らない）
+    session = boto3.session.Session()
+    s3 = session.client(
         "s3",
         endpoint_url=os.environ["S3_ENDPOINT"],  # 例: https://<accountid>.r2.cloudflarestorage.com
         aws_access_key_id=os.environ["S3_ACCESS_KEY"],
         aws_secret_access_key=os.environ["S3_SECRET_KEY"],
-        config=Config(signature_version="s3v4"),
+        config=Config(signature_version="s3v4", max_pool_connections=50, tcp_keepalive=True),
     )
     return s3, os.environ["S3_BUCKET"]
   
 def ensure_schema():
-    with psycopg.connect(DB_URL, autocommit=True) as conn:
+    with app.state.pool.connection() as conn:
         with conn.cursor() as cur:
+            # 既にテーブルが揃っていれば DDL は流さない（create ... if not exists でもロックを取るため）
+            cur.execute("""
+              select to_regclass('raw_sales') is not null
+                 and to_regclass('menu_master') is not null
+                 and to_regclass('ai_reports') is not null
+            """)
+            if cur.fetchone()[0]:
+                return
             cur.execute(DDL)
 
 @app.on_event("startup")
 def on_startup():
+    # リクエストごとの接続（TCP+TLS+認証）を避けるためアプリ全体でプールを共有
+    app.state.pool = ConnectionPool(
+        DB_URL, min_size=2, max_size=10, kwargs={"autocommit": True}, open=True
+    )
     ensure_schema()
 
+@app.on_event("shutdown")
+def on_shutdown():
+    app.state.pool.close()
+
 @app.get("/", response_class=HTMLResponse)
 def index():
     return """
@@ -74,23 +109,129 @@ def health():
 
 @app.get("/db-ping")
 def db_ping():
-    with psycopg.connect(DB_URL) as conn:
+    with app.state.pool.connection() as conn:
         with conn.cursor() as cur:
             cur.execute("select 1")
             one = cur.fetchone()[0]
     return {"db": "ok", "select1": one}
 
+TS_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S", "%Y-%m-%d", "%Y/%m/%d")
+
+def _is_ts_shape(s: str) -> bool:
+    """
+    YYYY-MM-DD / YYYY-MM-DD HH:MM:SS（区切りは - か / で揃っていること）の形か。
+    ciso8601 は ISO-8601 の他の形（2025-08、20250820、週番号、24:00、TZ付き等）も
+    受け付けてしまうので、TS_FORMATS と同じ形のものだけ渡すために使う。
+    """
+    n = len(s)
+    if n not in (10, 19) or s[4] != s[7] or s[4] not in "-/":
+        return False
+    return n == 10 or (s[10] == " " and s[13] == s[16] == ":" and s[11:13] != "24")
+
+@lru_cache(maxsize=65536)
 def parse_ts(s: str) -> datetime:
     """よくあるフォーマットだけ素直に対応（必要なら拡張）"""
-    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S", "%Y-%m-%d", "%Y/%m/%d"):
+    s = s.strip()
+    if _is_ts_shape(s):
+        try:
+            # TS_FORMATS と同じ形のものだけC実装で（YYYY/MM/DD は区切りを置換して）
+            return ciso8601.parse_datetime(s.replace("/", "-", 2))
+        except ValueError:
+            pass
+    for fmt in TS_FORMATS:
         try:
-            return datetime.strptime(s.strip(), fmt)
-        except Exception:
+            return datetime.strptime(s, fmt)
+        except ValueError:
             pass
     raise ValueError(f"Unsupported datetime format: {s}")
 
+def _ts_ymd_hms(s: str) -> datetime:
+    """YYYY-MM-DD HH:MM:SS（YYYY/MM/DD も可）を strptime を使わず切り出しで読む"""
+    # 区切り位置と数字だけかを毎回確認する（int() は符号や空白も通すため）
+    if (len(s) == 19 and _is_ts_shape(s)
+            and (s[0:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16] + s[17:19]).isdigit()):
+        try:
+            return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                            int(s[11:13]), int(s[14:16]), int(s[17:19]))
+        except ValueError:
+            pass
+    return parse_ts(s)
+
+def _ts_ymd(s: str) -> datetime:
+    """YYYY-MM-DD（YYYY/MM/DD も可）を strptime を使わず切り出しで読む"""
+    if len(s) == 10 and _is_ts_shape(s) and (s[0:4] + s[5:7] + s[8:10]).isdigit():
+        try:
+            return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+        except ValueError:
+            pass
+    return parse_ts(s)
+
+def ts_parser_for(sample: str):
+    """
+    1行目の日時文字列から、そのCSV専用のパーサを選ぶ。
+    CSVはほぼ全行同じ形式なので、形が合わない行だけ parse_ts に落とす。
+    """
+    s = sample.strip()
+    if len(s) >= 10 and s[4] == s[7] and s[4] in "-/":
+        if len(s) == 19 and s[10] == " " and s[13] == s[16] == ":":
+            return _ts_ymd_hms
+        if len(s) == 10:
+            return _ts_ymd
+    return parse_ts
+
+def _is_int(s: str) -> bool:
+    """int() が受け付ける整数か（符号1つ＋数字）を例外なしで判定する"""
+    return (s[1:] if s[:1] in ("+", "-") else s).isdecimal()
+
+RAW_SALES_COLS = "store_id, ts, menu_id, qty, price, age_band, gender, party_size, channel"
+COPY_RAW_SALES = f"copy raw_sales ({RAW_SALES_COLS}) from stdin"
+INSERT_RAW_SALES = f"insert into raw_sales ({RAW_SALES_COLS}) values (%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+# COPY 1回あたりの行数（失敗時に巻き戻す単位）
+COPY_CHUNK_ROWS = 10_000
+# COPY 失敗時の executemany 1回あたりの行数
+INSERT_BATCH_ROWS = 1_000
+# 取り込めなかった行をログに出す件数の上限
+BAD_ROW_SAMPLES = 10
+
+def copy_sales_chunk(conn: psycopg.Connection, rows: list[tuple]) -> int:
+    """
+    rows を COPY FROM STDIN で一括投入し、入った行数を返す。
+    COPY が失敗したらそのチャンクだけ巻き戻し、executemany で入れ直す。
+    """
+    try:
+        with conn.transaction():
+            with conn.cursor() as cur:
+                with cur.copy(COPY_RAW_SALES) as cp:
+                    for r in rows:
+                        cp.write_row(r)
+        return len(rows)
+    except psycopg.Error as e:
+        logger.warning("COPY chunk failed, retrying with executemany: %s", e)
+
+    inserted = 0
+    it = iter(rows)
+    with conn.cursor() as cur:
+        while batch := list(islice(it, INSERT_BATCH_ROWS)):
+            try:
+                # psycopg3 の executemany はパイプラインで送るので往復は1回
+                with conn.transaction():
+                    cur.executemany(INSERT_RAW_SALES, batch)
+                inserted += len(batch)
+                continue
+            except psycopg.Error as e:
+                logger.warning("insert batch failed, retrying row by row: %s", e)
+            # バッチ内のどこかが悪いときだけ1行ずつ
+            for r in batch:
+                try:
+                    with conn.transaction():
+                        cur.execute(INSERT_RAW_SALES, r)
+                    inserted += 1
+                except psycopg.Error as e:
+                    logger.warning("insert row failed: %s %s", e, r)
+    return inserted
+
 @app.post("/ingest/sales")
-async def ingest_sales(
+def ingest_sales(
     store_id: int = Query(..., description="店舗ID（例: 1）"),
     file: UploadFile = File(..., description="売上CSV")
 ):
@@ -103,51 +244,88 @@ async def ingest_sales(
     if not file.filename.endswith(".csv"):
         raise HTTPException(400, "CSVファイルをアップロードしてください。")
 
-    data = await file.read()
-    text = data.decode("utf-8-sig")
-    reader = csv.DictReader(io.StringIO(text))
+    # def エンドポイントなのでスレッドプールで動く（DB/S3 の同期I/Oでイベントループを止めない）
+    # ファイル全体を読み込まず、デコードしながら1行ずつ流す（メモリはチャンク分だけ）
+    text = io.TextIOWrapper(file.file, encoding="utf-8-sig", newline="")
+    reader = csv.reader(text)
+    header = [h.strip() for h in next(reader, [])]
     required = {"timestamp","menu_id","qty","price"}
-    if not required.issubset({h.strip() for h in reader.fieldnames or []}):
-        raise HTTPException(400, f"CSVヘッダに {required} が必要です。実際: {reader.fieldnames}")
+    if not required.issubset(header):
+        raise HTTPException(400, f"CSVヘッダに {required} が必要です。実際: {header}")
+    # 行ごとの dict を作らず、列位置で直接参照する
+    idx = {name: i for i, name in enumerate(header)}
+    i_ts, i_menu, i_qty, i_price = idx["timestamp"], idx["menu_id"], idx["qty"], idx["price"]
+    width = len(header)
+    # 無い任意列はヘッダ幅の直後に足す空欄列を指させる（行ループで None チェックをしないため）
+    i_age, i_gender, i_party, i_channel = (idx.get(k, width) for k in ("age_band", "gender", "party_size", "channel"))
+    add_blank = width in (i_age, i_gender, i_party, i_channel)
 
     inserted = 0
-    with psycopg.connect(DB_URL, autocommit=True) as conn:
-        with conn.cursor() as cur:
-            for row in reader:
-                try:
-                    ts = parse_ts(row["timestamp"])
-                    menu_id = row["menu_id"].strip()
-                    qty = int(row["qty"])
-                    price = int(row["price"])
-                    age_band = (row.get("age_band") or "").strip() or None
-                    gender   = (row.get("gender") or "").strip() or None
-                    party_sz = row.get("party_size")
-                    party_sz = int(party_sz) if party_sz not in (None,"") else None
-                    channel  = (row.get("channel") or "").strip() or None
-
-                    cur.execute(
-                        """
-                        insert into raw_sales
-                          (store_id, ts, menu_id, qty, price, age_band, gender, party_size, channel)
-                        values (%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                        """,
-                        (store_id, ts, menu_id, qty, price, age_band, gender, party_sz, channel)
-                    )
-                    inserted += 1
-                except Exception as e:
-                    # 1行おきに失敗しても全体は続行
-                    print("ROW ERROR:", e, row)
-    return JSONResponse({"status": "ok", "inserted": inserted})
+    skipped = 0
+    bad_samples = []  # ログに出す不正行の例（先頭数件だけ保持）
+    with app.state.pool.connection() as conn:
+        # 全体を1トランザクションにし、チャンクごとに SAVEPOINT を切る
+        with conn.transaction():
+            chunk = []
+            parse_row_ts = None
+            # 行ループ内で使う関数はローカルに束縛しておく（グローバル/属性の参照を省く）
+            strip, is_int, to_int, append = str.strip, _is_int, int, chunk.append
+            for line_no, row in enumerate(reader, start=2):
+                if not row:
+                    # 空行は DictReader と同じく読み飛ばす
+                    continue
+                if len(row) != width:
+                    # ヘッダより多い列は捨て、省略された末尾の空欄は埋める（DictReader と同じ扱い）
+                    row = row[:width]
+                    row += [""] * (width - len(row))
+                if add_blank:
+                    row.append("")
+                # 例外を投げさせず文字列チェックで弾く（1行おきに失敗しても全体は続行）
+                qty_s = strip(row[i_qty])
+                price_s = strip(row[i_price])
+                party_s = strip(row[i_party])
+                ts_s = strip(row[i_ts])
+                if parse_row_ts is None:
+                    parse_row_ts = ts_parser_for(ts_s)
+                ts = None
+                if is_int(qty_s) and is_int(price_s) and (not party_s or is_int(party_s)):
+                    try:
+                        ts = parse_row_ts(ts_s)
+                    except ValueError:
+                        pass
+                if ts is None:
+                    skipped += 1
+                    if len(bad_samples) < BAD_ROW_SAMPLES:
+                        bad_samples.append((line_no, row))
+                    continue
+                append((store_id, ts, strip(row[i_menu]), to_int(qty_s), to_int(price_s),
+                        strip(row[i_age]) or None, strip(row[i_gender]) or None,
+                        to_int(party_s) if party_s else None, strip(row[i_channel]) or None))
+                if len(chunk) >= COPY_CHUNK_ROWS:
+                    inserted += copy_sales_chunk(conn, chunk)
+                    chunk.clear()
+            if chunk:
+                inserted += copy_sales_chunk(conn, chunk)
+    if skipped:
+        logger.warning("ingest_sales store_id=%s: skipped %d rows, e.g. (line, row): %s",
+                       store_id, skipped, bad_samples)
+    return ORJSONResponse({"status": "ok", "inserted": inserted, "skipped": skipped})
 
 # --- 既存 main.py の末尾などに追記 ---
 from typing import Optional
 from fastapi import Query
 
+def _json_default(o):
+    # numeric 列（avg_price など）は Decimal で来るので数値として出す
+    if isinstance(o, Decimal):
+        return float(o)
+    raise TypeError
+
 @app.get("/analytics/menu-daily")
 def menu_daily(
     store_id: Optional[int] = Query(None),
-    date_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
-    date_to: Optional[str] = Query(None, description="YYYY-MM-DD（含まれない上限）")
+    date_from: Optional[date] = Query(None, description="YYYY-MM-DD"),
+    date_to: Optional[date] = Query(None, description="YYYY-MM-DD（含まれない上限）")
 ):
     cond = []
     params = {}
@@ -168,28 +346,47 @@ def menu_daily(
       order by day desc, sales_sum desc
       limit 500
     """
-    with psycopg.connect(DB_URL) as conn:
-        with conn.cursor() as cur:
-            cur.execute(sql, params)
-            cols = [d[0] for d in cur.description]
-            rows = [dict(zip(cols, r)) for r in cur.fetchall()]
-    return {"rows": rows}
+
+    # 接続取得とクエリ実行はヘッダ送信前に済ませる（失敗は通常のエラー応答になる）
+    with ExitStack() as stack:
+        conn = stack.enter_context(app.state.pool.connection())
+        stack.enter_context(conn.transaction())
+        cur = stack.enter_context(conn.cursor(name="menu_daily_stream"))
+        cur.execute(sql, params)
+        cols = [d[0] for d in cur.description]
+        resources = stack.pop_all()
+
+    def gen():
+        # サーバサイドカーソルで少しずつ取り出し、1行ずつ NDJSON で返す
+        try:
+            for r in cur:
+                yield orjson.dumps(dict(zip(cols, r)), default=_json_default) + b"\n"
+        finally:
+            resources.close()
+
+    # クライアント切断で gen() が最後まで回らなくても、応答後に接続をプールへ返す
+    return StreamingResponse(gen(), media_type="application/x-ndjson",
+                             background=BackgroundTask(resources.close))
 
 # --- 末尾あたりに追加 ---
 @app.post("/ingest/menu-photo")
-async def ingest_menu_photo(
+def ingest_menu_photo(
     store_id: int = Query(...),
     menu_id: str = Query(...),
     file: UploadFile = File(...)
 ):
     s3, bucket = s3_client()
     key = f"menu/{store_id}/{menu_id}.jpg"
-    body = await file.read()
-    s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType=file.content_type or "image/jpeg")
+    # 全体を読み込まず、8MBずつマルチパートでそのまま流す
+    s3.upload_fileobj(
+        file.file, bucket, key,
+        ExtraArgs={"ContentType": file.content_type or "image/jpeg"},
+        Config=S3_TRANSFER_CONFIG,
+    )
     # 画像URLは後で公開設定に応じて決める。ここでは key を返す
     img_url = f"s3://{bucket}/{key}"
 
-    with psycopg.connect(DB_URL, autocommit=True) as conn:
+    with app.state.pool.connection() as conn:
         with conn.cursor() as cur:
             cur.execute("""
               insert into menu_master (store_id, menu_id, img_url)
@@ -229,7 +426,7 @@ def report_generate(store_id: int = Query(...)):
       from raw_sales where store_id=%s and ts >= now() - interval '7 days'
       group by menu_id order by sales desc limit 5
     """
-    with psycopg.connect(DB_URL) as conn:
+    with app.state.pool.connection() as conn:
         with conn.cursor() as cur:
             cur.execute(sql, (store_id,))
             rows = cur.fetchall()
@@ -240,7 +437,7 @@ def report_generate(store_id: int = Query(...)):
     api_key = getenv("GEMINI_API_KEY")
     if not api_key:
         body = f"【ダミー】直近7日サマリー\n{summary}\n\n本番キーを設定すると文章化します。"
-        with psycopg.connect(DB_URL, autocommit=True) as conn:
+        with app.state.pool.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     "insert into ai_reports(store_id, kind, body_md) values (%s,%s,%s)",
@@ -264,7 +461,7 @@ def report_generate(store_id: int = Query(...)):
     res = client.models.generate_content(model="gemini-2.0-flash", contents=prompt)
     text = res.text or "(no text)"
 
-    with psycopg.connect(DB_URL, autocommit=True) as conn:
+    with app.state.pool.connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 "insert into ai_reports(store_id, kind, body_md) values (%s,%s,%s)",
@@ -39,7 +39,11 @@ MAX_YEARS_BACK = int(os.environ.get("MAX_YEARS_BACK", "5"))
 DDL_RAW_SALES_INDEXES = """
 -- 集計速度のための推奨インデックス（存在しなければ作成）
 create index if not exists idx_raw_sales_store_ts on raw_sales(store_id, ts);
-create index if not exists idx_raw_sales_ts on raw_sales(ts);
+-- 追記のみの時系列なので ts の範囲スキャンは BRIN で十分（btree の数百分の1のサイズ、取り込み時の更新も軽い）
+-- ts の btree があるとプランナがそちらを選び BRIN が使われないため、ts 単独の btree は置かない
+create index if not exists brin_raw_sales_ts on raw_sales using brin(ts) with (pages_per_range=32);
+drop index if exists idx_raw_sales_ts;
+drop index if exists idx_raw_sales_ts_store_menu_include;
 """
 
 DDL_FEAT_MENU_DAILY = """
@@ -53,23 +57,37 @@ create table if not exists feat_menu_daily(
   avg_price numeric(10,2),
   primary key (day, store_id, menu_id)
 );
+-- /analytics/menu-daily の order by day desc, sales_sum desc をソートなしで返すため
+create index if not exists idx_feat_menu_daily_perf
+  on feat_menu_daily(store_id, day desc, sales_sum desc)
+  include (menu_id, qty_sum, orders, avg_price);
 """
 
-UPSERT_RANGE = """
+# ローカル日付 [date_from, date_to) を SQL 側で1日ずつ展開して1回で集計する。
+# 日の境界（ローカル00:00→timestamptz）は日ごとに1回だけ計算し、行ごとのTZ変換はしない
+# （サマータイムで23/25時間の日も境界はTZどおり）。
+UPSERT_DAYS = """
+with days as (
+  select generate_series(%(date_from)s::timestamp,
+                         %(date_to)s::timestamp - interval '1 day',
+                         interval '1 day')::date as day_local
+)
 insert into feat_menu_daily
   (day, store_id, menu_id, qty_sum, sales_sum, orders, avg_price)
 select
-  (ts at time zone 'UTC' at time zone %(tz)s)::date as day_local,
-  store_id,
-  menu_id,
-  sum(qty) as qty_sum,
-  sum(qty*price) as sales_sum,
+  d.day_local,
+  r.store_id,
+  r.menu_id,
+  sum(r.qty) as qty_sum,
+  sum(r.qty*r.price) as sales_sum,
   count(*) as orders,
-  avg(price)::numeric(10,2) as avg_price
-from raw_sales
-where ts >= %(start_utc)s and ts < %(end_utc)s
-  and (%(store_id)s is null or store_id=%(store_id)s)
-group by 1,2,3
+  avg(r.price)::numeric(10,2) as avg_price
+from days d
+join raw_sales r
+  on r.ts >= (d.day_local::timestamp at time zone %(tz)s)
+ and r.ts <  ((d.day_local + 1)::timestamp at time zone %(tz)s)
+where (%(store_id)s is null or r.store_id=%(store_id)s)
+group by d.day_local, r.store_id, r.menu_id
 on conflict (day, store_id, menu_id) do update
   set qty_sum   = excluded.qty_sum,
       sales_sum = excluded.sales_sum,
@@ -97,17 +115,20 @@ def to_utc_range_for_local_day(day_local: date, tz: ZoneInfo) -> tuple[datetime,
     end_utc = end_local.astimezone(timezone.utc)
     return start_utc, end_utc
 
-def aggregate_range(conn: psycopg.Connection, start_utc: datetime, end_utc: datetime,
-                    store_id: int | None, tz_name: str):
+def aggregate_days(conn: psycopg.Connection, date_from: date, date_to: date,
+                   store_id: int | None, tz_name: str):
+    """
+    ローカル日付 date_from(含む)〜date_to(含まない) を UPSERT_DAYS 1回で集計する。
+    """
     with conn.cursor() as cur:
         cur.execute(
-            UPSERT_RANGE,
-            {"start_utc": start_utc, "end_utc": end_utc,
+            UPSERT_DAYS,
+            {"date_from": date_from, "date_to": date_to,
              "store_id": store_id, "tz": tz_name}
         )
 
 # ==== メイン処理 ======================================================
-def run_yesterday(store_id: int | None):
+def run_yesterday(conn: psycopg.Connection, store_id: int | None):
     tz = ZoneInfo(AGG_TZ)
     today_local = datetime.now(tz).date()
     target_day = today_local - timedelta(days=1)
@@ -117,57 +138,43 @@ def run_yesterday(store_id: int | None):
         f"range_utc=[{s_utc.isoformat()} .. {e_utc.isoformat()}) "
         f"store_id={store_id}")
 
-    with psycopg.connect(DB_URL, autocommit=True) as conn:
-        ensure_schema_and_indexes(conn)
-        aggregate_range(conn, s_utc, e_utc, store_id, AGG_TZ)
+    aggregate_days(conn, target_day, today_local, store_id, AGG_TZ)
 
-def run_all(store_id: int | None):
+def run_all(conn: psycopg.Connection, store_id: int | None):
     tz = ZoneInfo(AGG_TZ)
     # 安全装置: MAX_YEARS_BACK 年より古いものは拾わない
     min_day = (datetime.now(tz) - timedelta(days=365 * MAX_YEARS_BACK)).date()
 
     log(f"rebuild ALL (last {MAX_YEARS_BACK} years, local={AGG_TZ}) store_id={store_id}")
 
-    with psycopg.connect(DB_URL, autocommit=True) as conn:
-        ensure_schema_and_indexes(conn)
-        with conn.cursor() as cur:
-            # 最古・最新のUTC時刻を raw_sales から拾う（ある程度の上限つき）
-            cur.execute("""
-                select min(ts), max(ts) from raw_sales
-                where (%s is null or store_id=%s)
-            """, (store_id, store_id))
-            row = cur.fetchone()
-            if not row or not row[0] or not row[1]:
-                log("raw_sales has no data. nothing to do.")
-                return
-            min_ts_utc, max_ts_utc = row
-
-        # ローカル日付レンジへ（丸め）
-        first_local_day = min_ts_utc.astimezone(tz).date()
-        last_local_day  = max_ts_utc.astimezone(tz).date()
-        if first_local_day < min_day:
-            first_local_day = min_day
-
-        # 1日ずつ処理（必要に応じて週単位/バルクに最適化可）
-        cur_day = first_local_day
-        count = 0
-        with psycopg.connect(DB_URL, autocommit=True) as conn2:
-            ensure_schema_and_indexes(conn2)
-            while cur_day <= last_local_day:
-                s_utc, e_utc = to_utc_range_for_local_day(cur_day, tz)
-                aggregate_range(conn2, s_utc, e_utc, store_id, AGG_TZ)
-                if count % 20 == 0:
-                    log(f" aggregated up to {cur_day} ...")
-                cur_day += timedelta(days=1)
-                count += 1
-        log(f"done. days={count}, range={first_local_day}..{last_local_day}")
-
-def run_range(date_from: str, date_to: str | None, store_id: int | None):
+    with conn.cursor() as cur:
+        # 最古・最新のUTC時刻を raw_sales から拾う（ある程度の上限つき）
+        cur.execute("""
+            select min(ts), max(ts) from raw_sales
+            where (%s is null or store_id=%s)
+        """, (store_id, store_id))
+        row = cur.fetchone()
+        if not row or not row[0] or not row[1]:
+            log("raw_sales has no data. nothing to do.")
+            return
+        min_ts_utc, max_ts_utc = row
+
+    # ローカル日付レンジへ（丸め）
+    first_local_day = min_ts_utc.astimezone(tz).date()
+    last_local_day  = max_ts_utc.astimezone(tz).date()
+    if first_local_day < min_day:
+        first_local_day = min_day
+
+    # 全期間を1回のUPSERTで（日付の展開は SQL の generate_series）
+    aggregate_days(conn, first_local_day, last_local_day + timedelta(days=1), store_id, AGG_TZ)
+    days = (last_local_day - first_local_day).days + 1
+    log(f"done. days={days}, range={first_local_day}..{last_local_day}")
+
+def run_range(conn: psycopg.Connection, date_from: str, date_to: str | None, store_id: int | None):
     """
     date_from (含む) 〜 date_to(含まない) をローカルTZで集計。
     date_to 未指定なら date_from の1日分。
     """
-    tz = ZoneInfo(AGG_TZ)
     try:
         df = datetime.strptime(date_from, "%Y-%m-%d").date()
     except ValueError:
@@ -182,17 +189,9 @@ def run_range(date_from: str, date_to: str | None, store_id: int | None):
 
     log(f"aggregate range (local={AGG_TZ}) from={df} to={dt} store_id={store_id}")
 
-    with psycopg.connect(DB_URL, autocommit=True) as conn:
-        ensure_schema_and_indexes(conn)
-        # 1日単位でループ（境界にサマータイム等があっても安全）
-        cur_day = df
-        count = 0
-        while cur_day < dt:
-            s_utc, e_utc = to_utc_range_for_local_day(cur_day, tz)
-            aggregate_range(conn, s_utc, e_utc, store_id, AGG_TZ)
-            cur_day += timedelta(days=1)
-            count += 1
-        log(f"done. days={count}")
+    # 1日単位の境界は SQL 側でローカルTZから求める（サマータイム等があっても安全）
+    aggregate_days(conn, df, dt, store_id, AGG_TZ)
+    log(f"done. days={max((dt - df).days, 0)}")
 
 def main(argv=None):
     parser = argparse.ArgumentParser(description="Daily aggregation job")
@@ -205,14 +204,18 @@ def main(argv=None):
 
     log(f"start mode={args.mode}, tz={AGG_TZ}, store_id={args.store_id}")
 
-    if args.mode == "yesterday":
-        run_yesterday(args.store_id)
-    elif args.mode == "range":
-        if not args.date_from:
-            raise SystemExit("ERROR: mode=range では --from YYYY-MM-DD が必須です。")
-        run_range(args.date_from, args.date_to, args.store_id)
-    elif args.mode == "all":
-        run_all(args.store_id)
+    if args.mode == "range" and not args.date_from:
+        raise SystemExit("ERROR: mode=range では --from YYYY-MM-DD が必須です。")
+
+    # ジョブ全体で接続は1本だけ
+    with psycopg.connect(DB_URL, autocommit=True) as conn:
+        ensure_schema_and_indexes(conn)
+        if args.mode == "yesterday":
+            run_yesterday(conn, args.store_id)
+        elif args.mode == "range":
+            run_range(conn, args.date_from, args.date_to, args.store_id)
+        elif args.mode == "all":
+            run_all(conn, args.store_id)
 
     log("finished")
 